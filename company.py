@@ -1,45 +1,75 @@
-import re
-import csv
+from typing import List, Optional, Tuple
 
-from typing import List
-
-import bs4
 import httpx
+from lxml import etree
 
 from http_session import HTTPSession
-
-
-def scrape_contacts_v1(contacts_page: bs4.BeautifulSoup) -> List[str]:
-    contact_table = contacts_page.find(class_="contact-table")
-    email_spans = contact_table.find_all(attrs={"itemprop": "email"})
-    # TODO: Maybe include the employee emails
-
-    company_emails = [email_ref["href"] for email_span in email_spans for email_ref in email_span.find_all(name="a")]
-
-    return company_emails
-
-
-def scrape_contacts_v2(contacts_page: bs4.BeautifulSoup) -> List[str]:
-    div_contacts = contacts_page.find(id="divContacts")
-    email_spans = div_contacts.find_all(attrs={"itemprop": "email"})
-    company_emails = [email_ref["href"] for email_span in email_spans for email_ref in email_span.find_all(name="a")]
-
-    return company_emails
-
-
-mailto_regex = re.compile("^mailto:")
-def scrape_contacts_v3(contacts_page: bs4.BeautifulSoup) -> List[str]:
-    if contacts_page.find(string="Živnost subjektu byla ukončena.") is not None:
-        return []
-
-    name_elem = contacts_page.find(id="h1Nadpis", attrs={"itemprop": "legalName"})
-    contacts_div = name_elem.parent.parent
-    email_anchors = contacts_div.find_all(name="a", href=mailto_regex)
-    emails = [anchor["href"] for anchor in email_anchors]
-    return emails
+from html_parsing import parse_html_tree, run_in_thread
+
+MAILTO_PREFIX = "mailto:"
+_MAILTO_PREFIX_LEN = len(MAILTO_PREFIX)
+CSV_FIELDS = ["name", "email", "group", "url"]
+
+_TEXT_XPATH = etree.XPath("string()", smart_strings=False)
+_CONTACT_TABLE_XPATH = etree.XPath('(//*[contains(concat(" ", normalize-space(@class), " "), " contact-table ")])[1]')
+_EMAIL_HREFS_XPATH = etree.XPath('.//*[@itemprop="email"]//a/@href', smart_strings=False)
+_MAILTO_HREFS_XPATH = etree.XPath('.//a[starts-with(@href, "mailto:")]/@href', smart_strings=False)
+# Elements marking each of the three contact page formats
+_FORMAT_MARKERS_XPATH = etree.XPath('//*[@id="h3CompanyName" or @id="divContacts" or (@id="h1Nadpis" and @itemprop="legalName")]')
+_IS_TERMINATED_XPATH = etree.XPath('boolean(//text()[. = "Živnost subjektu byla ukončena."])')
+
+
+def strip_mailto(hrefs: List[str]) -> List[str]:
+    # TODO: Properly parse URL
+    return [href[_MAILTO_PREFIX_LEN:] if href.startswith(MAILTO_PREFIX) else href for href in hrefs]
+
+
+def _extract(content: etree._Element, contact_url: str) -> Tuple[str, List[str]]:
+    # There are three types of contact pages for some reason, so find the markers of all the formats in a single pass
+    #   and scrape the emails only from the subtree of the one that matched
+    markers = {}
+    for marker in _FORMAT_MARKERS_XPATH(content):
+        markers.setdefault(marker.get("id"), marker)
+
+    name_elem = markers.get("h3CompanyName", None)
+    if name_elem is not None:
+        # TODO: Maybe include the employee emails
+        contact_table = _CONTACT_TABLE_XPATH(content)[0]
+        return _TEXT_XPATH(name_elem), strip_mailto(_EMAIL_HREFS_XPATH(contact_table))
+
+    div_contacts = markers.get("divContacts", None)
+    if div_contacts is not None:
+        header_elem = div_contacts.find(".//h1")
+        if header_elem is None:
+            raise Exception(f"ERROR: Matched invalid v2 format, missing H1: {contact_url}")
+        name_elem = header_elem.find(".//span")
+        if name_elem is None:
+            raise Exception(f"ERROR: Matched invalid v2 format, missing name span: {contact_url}")
+        return _TEXT_XPATH(name_elem), strip_mailto(_EMAIL_HREFS_XPATH(div_contacts))
+
+    name_elem = markers.get("h1Nadpis", None)
+    if name_elem is not None:
+        if len(name_elem) == 0:
+            name = _TEXT_XPATH(name_elem)
+        else:
+            # TODO: Include the possible </br> elements
+            name = " ".join(text.strip() for text in name_elem.itertext() if text.strip())
+        if _IS_TERMINATED_XPATH(content):
+            return name, []
+        contacts_div = name_elem.getparent().getparent()
+        return name, [href[_MAILTO_PREFIX_LEN:] for href in _MAILTO_HREFS_XPATH(contacts_div)]
+
+    raise Exception(f"Unknown format for {contact_url}")
+
+
+def parse_contacts_page(page_content: bytes, encoding: Optional[str], contact_url: str) -> Tuple[str, List[str]]:
+    return _extract(parse_html_tree(page_content, encoding), contact_url)
 
 
 class Company:
+    # A full crawl keeps many companies around, so avoid a per-instance __dict__
+    __slots__ = ("name", "group", "contacts_url", "emails")
+
     def __init__(self, name: str, group: "Group", contacts_url: str, emails: List[str]):
         assert (name is not None)
         self.name = name
@@ -48,49 +78,15 @@ class Company:
         self.emails = emails
 
     @classmethod
-    def scrape_company(cls, session: HTTPSession, contact_url: str, group: "Group") -> "Company":
-        resp = session.delayed_get(contact_url)
+    async def scrape_company(cls, session: HTTPSession, contact_url: str, group: "Group") -> "Company":
+        resp = await session.delayed_get(contact_url)
         if resp.status_code != httpx.codes.OK:
             # TODO: Log error
             raise Exception(f"Contact request failed with {resp.status_code}, url {resp.url}, {resp.request.url} {resp.request.headers}")
 
-        # There are three types of contact pages for some reason, so we need to distinguish between them
-        #   and scrape each one differently
-        content = bs4.BeautifulSoup(resp.text, "lxml")
-        name_elem = content.find(id="h3CompanyName")
-        if name_elem is not None:
-            name = name_elem.string
-            emails = scrape_contacts_v1(content)
-            return Company(name, group, contact_url, emails)
-
-        div_contacts = content.find(id="divContacts")
-        if div_contacts is not None:
-            header_elem = div_contacts.find(name="h1")
-            if header_elem is None:
-                raise Exception(f"ERROR: Matched invalid v2 format, missing H1: {contact_url}")
-            name_elem = header_elem.find(name="span")
-            if name_elem is None:
-                raise Exception(f"ERROR: Matched invalid v2 format, missing name span: {contact_url}")
-
-            name = name_elem.string
-            emails = scrape_contacts_v2(content)
-            return Company(name, group, contact_url, emails)
-
-        name_elem = content.find(id="h1Nadpis", attrs={"itemprop": "legalName"})
-        if name_elem is not None:
-            if len(name_elem.contents) == 1:
-                name = name_elem.string
-            else:
-                # TODO: Include the possible </br> elements
-                name = " ".join(name_elem.stripped_strings)
-            emails = scrape_contacts_v3(content)
-            return Company(name, group, contact_url, emails)
-
-        raise Exception(f"Unknown format for {contact_url}")
-
-    def to_csv(self, csv_out: csv.DictWriter):
-        for email in self.emails:
-            # TODO: Properly parse URL
-            if email.startswith("mailto:"):
-                email = email[len("mailto:"):]
-            csv_out.writerow({"name": self.name, "email": email, "group": self.group.name, "url": self.contacts_url})
+        name, emails = await run_in_thread(parse_contacts_page, resp.content, resp.charset_encoding, contact_url)
+        return Company(name, group, contact_url, emails)
+
+    def to_csv_rows(self) -> List[Tuple[str, str, str, str]]:
+        # Same order as CSV_FIELDS
+        return [(self.name, email, self.group.name, self.contacts_url) for email in self.emails]
@@ -0,0 +1,12 @@
+import gzip
+from pathlib import Path
+from typing import IO
+
+BUFFER_SIZE = 1 << 20
+
+
+def open_csv(path: Path, mode: str) -> IO[str]:
+    # Files ending with .gz are transparently gzip compressed, appending adds a new gzip member which readers handle
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return path.open(mode, buffering=BUFFER_SIZE, encoding="utf-8", newline="")
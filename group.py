@@ -1,96 +1,264 @@
+import os
+import html
+import json
 import random
 import re
 import sys
 import csv
-import json
-import time
+import asyncio
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Optional, Dict, Set
+from typing import AbstractSet, Callable, List, Optional, Dict, Tuple, Union
 
-import bs4
 import httpx
+from lxml import etree
 
 import argparse
 
-from http_session import HTTPSession
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from http_session import HTTPSession, create_client
+from html_parsing import iterparse_html, parse_html_tree, run_in_thread
+from csv_file import open_csv
 from company import Company
 
 COMPANIES_PER_PAGE = 25
+# Listing pages kept in memory across all groups, sampling draws random pages so over a long run they would pile up otherwise
+PAGE_CACHE_SIZE = 256
+
+# Group name to [number of pages, number of companies on the last page],
+#   older caches only have the number of pages
+GroupCache = Dict[str, Union[int, List[Optional[int]]]]
+
+# Contact urls on the recently fetched listing pages, keyed by group url and page, so that the page search,
+#   counting and sampling share requests, shared by all groups so the memory does not grow with their number
+_page_cache: "OrderedDict[Tuple[str, int], List[Optional[str]]]" = OrderedDict()
+
+_DIV_FIRMY_MARKER = b'id="divFirmy"'
+_ORGANIZATION_MARKER = b'itemtype="https://schema.org/Organization"'
+_ORGANIZATION_ITEMTYPE = "https://schema.org/Organization"
+_CONTACT_HREF_RE = re.compile(rb'href="([^"]+/kontakt)"')
+_DIV_TAG_RE = re.compile(rb'<(/?)div[\s>]', re.IGNORECASE)
+_PAGE_LINK_RE = re.compile(rb'href="[^"]*[?&;]p=(\d+)[^"]*"')
+_CATALOG_GROUPS_XPATH = etree.XPath('//div[contains(concat(" ", normalize-space(@class), " "), " col ")]//h3')
+_GROUP_NAME_XPATH = etree.XPath("string()", smart_strings=False)
+_GROUP_HREF_XPATH = etree.XPath("string(.//a/@href)", smart_strings=False)
+
+
+def _find_div_end(content: bytes, tag_pos: int) -> int:
+    # Position of the closing tag of the div whose opening tag contains tag_pos, -1 if it is not closed
+    depth = 1
+    for div_tag in _DIV_TAG_RE.finditer(content, tag_pos):
+        depth += -1 if div_tag.group(1) else 1
+        if depth == 0:
+            return div_tag.start()
+    return -1
+
+
+def _scan_company_urls(content: bytes, encoding: Optional[str]) -> List[Optional[str]]:
+    # Listing pages are only ever used for the contact urls, so find them directly in the raw response
+    #   instead of building the whole DOM, returning None for companies without a contact url
+    firmy_start = content.find(_DIV_FIRMY_MARKER)
+    if firmy_start == -1:
+        return []
+    # Links and organizations after the list, such as in the footer, must not be taken for companies,
+    #   if the end of the list cannot be found leave the page to the full parse
+    firmy_end = _find_div_end(content, firmy_start)
+    if firmy_end == -1:
+        return []
+
+    # Plain substring search, the marker is a literal so there is no need for the regex engine
+    company_starts = []
+    marker_start = content.find(_ORGANIZATION_MARKER, firmy_start, firmy_end)
+    while marker_start != -1:
+        company_start = marker_start + len(_ORGANIZATION_MARKER)
+        company_starts.append(company_start)
+        marker_start = content.find(_ORGANIZATION_MARKER, company_start, firmy_end)
+    company_ends = company_starts[1:] + [firmy_end]
+    company_urls = []
+    for start, end in zip(company_starts, company_ends):
+        href_match = _CONTACT_HREF_RE.search(content, start, end)
+        if href_match is None:
+            company_urls.append(None)
+            continue
+        # Decoded and unescaped the same way the parser does, so that both give the same urls for the exclude set
+        try:
+            company_urls.append(html.unescape(href_match.group(1).decode(encoding or "utf-8")))
+        except (UnicodeDecodeError, LookupError):
+            # Leave the page to the full parse, which detects the encoding itself
+            return []
+    return company_urls
+
 
 class GroupId:
     def __init__(self, name: str, url: str):
         self.name = name
         self.url = url
 
-contacts_regex = re.compile("/kontakt$")
 class Group:
-    def __init__(self, name: str, url: str, session: HTTPSession, group_cache: Dict[str, int]):
+    def __init__(self, name: str, url: str, session: HTTPSession, group_cache: GroupCache):
         self.name = name
         self.url = url
         self.session = session
-        self.num_pages: Optional[int] = group_cache.get(name, None)
-
-    def validate_num_pages(self) -> bool:
-        while True:
-            try:
-                # Validate the cache, checking if the number of pages did not change from previous run
-                if self.num_pages is not None and self._is_num_pages_valid(self.num_pages):
-                    return True
-                else:
-                    self.num_pages = None
-                    return False
-            except httpx.TimeoutException:
-                print("Error: Validation request timeout, retrying")
-                time.sleep(60)
-
-    def _is_num_pages_valid(self, expected_num_pages: int) -> bool:
-        return self.get_num_companies_on_page(expected_num_pages) != 0 and self.get_num_companies_on_page(expected_num_pages + 1) == 0
+        cache_entry = group_cache.get(name, None)
+        if isinstance(cache_entry, int):
+            # Old format, the last page count is fetched when first needed
+            cache_entry = [cache_entry, None]
+        self.num_pages: Optional[int] = cache_entry[0] if cache_entry is not None else None
+        self.last_page_count: Optional[int] = cache_entry[1] if cache_entry is not None else None
+        # Highest page linked from the pagination of the fetched pages, used as a hint for the number of pages
+        self._max_page_link: Optional[int] = None
+        # Called whenever the number of pages had to be found, so that it can be persisted right away
+        self.on_num_pages_found: Optional[Callable[["Group"], None]] = None
+
+    async def validate_num_pages(self) -> bool:
+        # Validate the cache, checking if the number of pages did not change from previous run
+        if self.num_pages is not None and await self._is_num_pages_valid(self.num_pages):
+            return True
+        else:
+            self.num_pages = None
+            self.last_page_count = None
+            return False
+
+    async def _is_num_pages_valid(self, expected_num_pages: int) -> bool:
+        # The boundary pages are what is being validated, so they have to be refetched
+        _page_cache.pop((self.url, expected_num_pages), None)
+        _page_cache.pop((self.url, expected_num_pages + 1), None)
+        return await self._is_last_page(expected_num_pages)
+
+    async def _is_last_page(self, page: int) -> bool:
+        last_page, after_last_page = await asyncio.gather(
+            self.get_num_companies_on_page(page),
+            self.get_num_companies_on_page(page + 1)
+        )
+        if last_page != 0 and after_last_page == 0:
+            # The number of pages may stay the same while the last page changes
+            self.last_page_count = last_page
+            return True
+        return False
+
+    async def _get_company_urls(self, page: int) -> List[Optional[str]]:
+        key = (self.url, page)
+        company_urls = _page_cache.get(key, None)
+        if company_urls is not None:
+            _page_cache.move_to_end(key)
+            return company_urls
+
+        company_urls = await self._fetch_company_urls(page)
+        _page_cache[key] = company_urls
+        if len(_page_cache) > PAGE_CACHE_SIZE:
+            _page_cache.popitem(last=False)
+        return company_urls
 
-    def _get_company_divs(self, page: int) -> bs4.element.ResultSet:
-        resp = self.session.delayed_get(self.url, params={"p": page})
+    async def _fetch_company_urls(self, page: int) -> List[Optional[str]]:
+        resp = await self.session.delayed_get(self.url, params={"p": page})
         if resp.status_code != httpx.codes.OK:
             raise Exception(f"{self.name}: Page {page} request failed with {resp.status_code}, url {resp.url}")
 
-        content = bs4.BeautifulSoup(resp.text, "lxml")
-        firmy_div = content.find(id="divFirmy")
-        if firmy_div is None:
-            raise Exception(f"{self.name}: Page {page} malformed, no divFirmy, url {self.url}")
+        if self.num_pages is None:
+            # Pages are numbered from 1, other links would only break the search
+            page_links = [page_link for page_link in map(int, _PAGE_LINK_RE.findall(resp.content)) if page_link >= 1]
+            if len(page_links) != 0:
+                self._max_page_link = max(self._max_page_link or 0, *page_links)
 
-        return firmy_div.find_all(name="div", attrs={"itemtype": "https://schema.org/Organization"})
+        company_urls = _scan_company_urls(resp.content, resp.charset_encoding)
+        if len(company_urls) != 0:
+            return company_urls
 
-    def get_num_companies_on_page(self, page: int) -> int:
-        return len(self._get_company_divs(page))
+        # Either we are past the last page or the scan did not match the markup, so check with the full parse
+        return await run_in_thread(self._parse_company_urls, resp.content, resp.charset_encoding, page)
 
-    def get_company_urls_on_page(self, page: int, exclude_set: Set[str]) -> List[str]:
-        company_divs = self._get_company_divs(page)
+    def _parse_company_urls(self, page_content: bytes, encoding: Optional[str], page: int) -> List[Optional[str]]:
         company_urls = []
-        for div in company_divs:
-            contact_url_elem = div.find(name="a", href=contacts_regex)
-            if contact_url_elem is None:
-                print(f"No contact url found in {div.prettify()}", file=sys.stderr)
-                return company_urls
+        div_firmy = None
+        company_div = None
+        for event, elem in iterparse_html(page_content, encoding, ("start", "end"), ("div", "a")):
+            if event == "start":
+                if elem.tag == "a":
+                    # Only the first contact anchor of each company is used
+                    if company_div is not None and company_urls[-1] is None:
+                        href = elem.get("href", "")
+                        if href.endswith("/kontakt"):
+                            company_urls[-1] = href
+                elif div_firmy is None:
+                    if elem.get("id") == "divFirmy":
+                        div_firmy = elem
+                elif company_div is None and elem.get("itemtype") == _ORGANIZATION_ITEMTYPE:
+                    company_div = elem
+                    company_urls.append(None)
+            elif elem is div_firmy:
+                # Nothing after the company list is needed, so do not even parse it
+                break
+            elif elem is company_div:
+                company_div = None
+                elem.clear()
+            elif div_firmy is None:
+                # Free the page header as we go, only the company list is kept
+                elem.clear()
+
+        if div_firmy is None:
+            raise Exception(f"{self.name}: Page {page} malformed, no divFirmy, url {self.url}")
+        return company_urls
 
-            company_url = contact_url_elem["href"]
-            if company_url not in exclude_set:
-                company_urls.append(company_url)
+    async def get_num_companies_on_page(self, page: int) -> int:
+        return len(await self._get_company_urls(page))
 
-        return company_urls
+    async def get_company_urls_on_page(self, page: int, exclude_set: AbstractSet[str]) -> List[str]:
+        company_urls = await self._get_company_urls(page)
+        if None in company_urls:
+            print(f"{self.name}: No contact url found for a company on page {page}, url {self.url}", file=sys.stderr)
+            company_urls = company_urls[:company_urls.index(None)]
 
-    def get_num_pages(self) -> int:
+        return [company_url for company_url in company_urls if company_url not in exclude_set]
+
+    async def get_num_pages(self) -> int:
         if self.num_pages is not None:
             return self.num_pages
 
-        max_page_lower = 1
-        max_page_upper = 50
+        num_pages = await self._find_num_pages()
+        # The last page was already fetched when finding the number of pages, so this is served from the page cache
+        self.last_page_count = await self.get_num_companies_on_page(num_pages) if num_pages > 0 else 0
+        self.num_pages = num_pages
+        if self.on_num_pages_found is not None:
+            self.on_num_pages_found(self)
+        return self.num_pages
+
+    async def _find_num_pages(self) -> int:
+        last_non_empty_page = 0
+        first_empty_page = 1
+
+        # The pagination on the first page usually links the last page, so check that before searching
+        await self.get_num_companies_on_page(1)
+        if self._max_page_link is not None:
+            # Pages fetched during the search are current, so unlike validation do not refetch them
+            if await self._is_last_page(self._max_page_link):
+                return self._max_page_link
+
+            # Only a window of pages is linked, but it is still a good place to start the search from,
+            #   and if the linked page is already empty it bounds the search from above instead
+            if await self.get_num_companies_on_page(self._max_page_link) > 0:
+                last_non_empty_page = self._max_page_link
+                first_empty_page = 2 * self._max_page_link
+            else:
+                first_empty_page = self._max_page_link
 
-        # Find upper bound for max page
-        while self.get_num_companies_on_page(max_page_upper) > 0:
-            max_page_upper += 50
+        # Find upper bound for max page, doubling so that the big groups do not need a linear number of requests
+        while await self.get_num_companies_on_page(first_empty_page) > 0:
+            last_non_empty_page = first_empty_page
+            # Always move forward, so that unexpected pages from the site cannot keep the search in place
+            first_empty_page = max(2 * first_empty_page, last_non_empty_page + 1)
+
+        # Only the pages between the last non-empty and the first empty page are left to search
+        max_page_lower = last_non_empty_page + 1
+        max_page_upper = first_empty_page - 1
 
         iter = 0
         while max_page_lower <= max_page_upper:
             mid_page = (max_page_upper + max_page_lower) // 2
-            if self.get_num_companies_on_page(mid_page) > 0:
+            if await self.get_num_companies_on_page(mid_page) > 0:
                 max_page_lower = mid_page + 1
             else:
                 max_page_upper = mid_page - 1
@@ -100,137 +268,189 @@ class Group:
             if iter > 200:
                 raise Exception(f"Too many iterations of the binary search: {iter}, Group: {self.url}, Stuck on: [{max_page_lower}, {max_page_upper}]")
 
-        self.num_pages = max_page_upper
-        return self.num_pages
+        return max_page_upper
+
+    async def get_random_company_urls(self, exclude_set: AbstractSet[str], num_companies: int) -> List[str]:
+        # Draw a company and take its page, so that pages are weighted by the number of companies on them
+        #   and the companies on the shorter last page are not oversampled
+        total_companies = await self.get_total_companies()
+        if total_companies == 0:
+            return []
+        company_index = random.randrange(total_companies)
+        page = company_index // COMPANIES_PER_PAGE + 1
+        company_urls = await self.get_company_urls_on_page(page, exclude_set)
+        return random.sample(company_urls, min(num_companies, len(company_urls)))
+
+    async def scrape_companies(self, company_urls: List[str]) -> List[Company]:
+        results = await asyncio.gather(
+            *[Company.scrape_company(self.session, company_url, self) for company_url in company_urls],
+            return_exceptions=True
+        )
+        companies = []
+        for company_url, result in zip(company_urls, results):
+            if isinstance(result, BaseException):
+                print(f"{self.name}: Scraping company {company_url} failed due to {result}", file=sys.stderr)
+            else:
+                companies.append(result)
+        return companies
+
+    async def get_total_companies(self) -> int:
+        num_pages = await self.get_num_pages()
+        if num_pages == 0:
+            return 0
+        if self.last_page_count is None:
+            self.last_page_count = await self.get_num_companies_on_page(num_pages)
+
+        return (num_pages - 1) * COMPANIES_PER_PAGE + self.last_page_count
+
+    def cache_entry(self) -> List[Optional[int]]:
+        return [self.num_pages, self.last_page_count]
 
-    def get_random_company(self, exclude_set: Set[str]) -> Optional[Company]:
-        num_pages = self.get_num_pages()
-        page = random.randint(1, num_pages)
-        company_urls = self.get_company_urls_on_page(page, exclude_set)
-        if len(company_urls) != 0:
-            company_url = random.choice(company_urls)
-            return Company.scrape_company(self.session, company_url, self)
-        else:
-            return None
 
-    def get_total_companies(self) -> int:
-        num_last_page_companies = self.get_num_companies_on_page(self.get_num_pages())
+def _loads_json(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-        return (self.get_num_pages() - 1) * COMPANIES_PER_PAGE + num_last_page_companies
 
+def _dumps_json(data) -> bytes:
+    # Indented, so that the cache can be checked and edited by hand
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf8")
 
-def scrape_groups(session: HTTPSession, group_cache: Path) -> List[Group]:
+
+def load_group_cache(group_cache: Path) -> GroupCache:
     try:
-        with group_cache.open("r") as f:
-            group_map = json.load(f)
+        with group_cache.open("rb") as f:
+            return _loads_json(f.read())
     except IOError:
-        group_map = {}
+        return {}
+
+
+def store_group_cache(groups: List[Group], group_cache: Path):
+    cache = {group.name: group.cache_entry() for group in groups if group.num_pages is not None}
+    # Write the whole file aside and swap it in, so that a killed run never leaves a truncated cache behind
+    tmp_path = group_cache.with_name(group_cache.name + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(_dumps_json(cache))
+    os.replace(tmp_path, group_cache)
+
 
-    group_ids = list_group_ids(session)
+async def scrape_groups(session: HTTPSession, group_cache: Path) -> List[Group]:
+    group_map = load_group_cache(group_cache)
+    group_ids = await list_group_ids(session)
     return [Group(group_id.name, group_id.url, session, group_map) for group_id in group_ids]
 
 
-def list_group_ids(session: HTTPSession) -> List[GroupId]:
-    resp = session.delayed_get("https://www.edb.cz/katalog-firem/")
+async def list_group_ids(session: HTTPSession) -> List[GroupId]:
+    resp = await session.delayed_get("https://www.edb.cz/katalog-firem/")
     if resp.status_code != httpx.codes.OK:
         raise Exception(f"Failed to get catalog: {resp.status_code}, {resp.text}")
 
-    catalog_page = bs4.BeautifulSoup(resp.text, "lxml")
-    columns = catalog_page.find_all(name="div", class_="col")
-    groups = [child for column in columns for child in column.find_all(name="h3")]
-    return [GroupId(group.string, group.a["href"]) for group in groups]
+    catalog_page = parse_html_tree(resp.content, resp.charset_encoding)
+    return [GroupId(_GROUP_NAME_XPATH(group), _GROUP_HREF_XPATH(group)) for group in _CATALOG_GROUPS_XPATH(catalog_page)]
 
 
-def num_site_groups(requests_per_second: int):
-    with httpx.Client() as client:
-        session = HTTPSession(client, 1 / requests_per_second)
-        groups = list_group_ids(session)
+async def num_site_groups(requests_per_second: int, concurrency: int, http_cache: Optional[Path]):
+    async with create_client(concurrency, http_cache) as client:
+        session = HTTPSession(client, requests_per_second, concurrency)
+        groups = await list_group_ids(session)
         print(len(groups))
 
 
 def num_cached_groups(group_cache_path: Path):
-    with group_cache_path.open("r") as f:
-        group_cache = json.load(f)
+    with group_cache_path.open("rb") as f:
+        group_cache = _loads_json(f.read())
         print(len(group_cache))
 
 
 def _num_site_groups(args: argparse.Namespace):
-    num_site_groups(args.limit)
+    asyncio.run(num_site_groups(args.limit, args.concurrency, args.http_cache))
 
 
 def _num_cached_groups(args: argparse.Namespace):
     num_cached_groups(args.group_cache)
 
 
-def get_groups(session: HTTPSession, group_cache_path: Path, with_cache_size_only: bool) -> List[Group]:
-    groups = scrape_groups(session, group_cache_path)
+async def get_groups(session: HTTPSession, group_cache_path: Path, with_cache_size_only: bool) -> List[Group]:
+    groups = await scrape_groups(session, group_cache_path)
     if with_cache_size_only:
         return [group for group in groups if group.num_pages is not None]
     else:
         return groups
 
 
-def fill_group_cache(groups: List[Group], group_cache_path: Path):
-    group_cache = {}
-    for idx, group in enumerate(groups):
-        print(f"[{idx + 1}/{len(groups)}] Filling {group.name}")
-        filled = False
-        while not filled:
-            try:
-                group_cache[group.name] = group.get_num_pages()
-                filled = True
-            except httpx.TimeoutException:
-                print("Error: Request timeout when filling cache, retrying")
-                time.sleep(60)
+async def fill_group_cache(groups: List[Group], group_cache_path: Path):
+    print(f"Filling {len(groups)} groups")
+    for group in groups:
+        group.on_num_pages_found = lambda _: store_group_cache(groups, group_cache_path)
+    # A group that runs out of retries is reported and left uncached, so that it does not abort filling the rest
+    results = await asyncio.gather(*[group.get_num_pages() for group in groups], return_exceptions=True)
+    for group, result in zip(groups, results):
+        if isinstance(result, BaseException):
+            print(f"{group.name}: Finding the number of pages failed due to {result}", file=sys.stderr)
+    store_group_cache(groups, group_cache_path)
 
-    with group_cache_path.open("w", encoding="utf8") as f:
-        json.dump(group_cache, f, ensure_ascii=False)
 
+async def _get_total_companies(group: Group) -> int:
+    num_companies = await group.get_total_companies()
+    print(f"{group.name}: {num_companies}")
+    return num_companies
 
-def get_group_size(group_cache_path: Path, output_path: Path, requests_per_second: int, fill_cache: bool, validate_cache: bool):
-    with httpx.Client() as client:
-        session = HTTPSession(client, 1 / requests_per_second)
-        groups = get_groups(session, group_cache_path, not fill_cache)
 
+async def get_group_size(group_cache_path: Path, output_path: Path, requests_per_second: int, concurrency: int, http_cache: Optional[Path], fill_cache: bool, validate_cache: bool):
+    async with create_client(concurrency, http_cache) as client:
+        session = HTTPSession(client, requests_per_second, concurrency)
+        groups = await get_groups(session, group_cache_path, not fill_cache)
+
+        # A group that runs out of retries is reported and left out of the output, so that it does not abort the others
+        counted_groups = groups
         if validate_cache:
-            for idx, group in enumerate(groups):
-                print(f"[{idx + 1}/{len(groups)}]: Validating {group.name}")
-                group.validate_num_pages()
-
-        group_sizes = []
-        for idx, group in enumerate(groups):
-            print(f"[{idx + 1}/{len(groups)}]: {group.name}")
-            num_companies = None
-            while num_companies is None:
-                try:
-                    num_companies = group.get_total_companies()
-                except httpx.TimeoutException:
-                    print("Error: Request timeout when getting number of companies in a group, retrying")
-
-            group_sizes.append({"group": group.name, "num_companies": group.get_total_companies()})
-
-        with output_path.open("w") as f:
-            out_csv = csv.DictWriter(f, fieldnames=["group", "num_companies"])
-            for group_size in group_sizes:
-                out_csv.writerow(group_size)
+            print(f"Validating {len(groups)} groups")
+            validity = await asyncio.gather(*[group.validate_num_pages() for group in groups], return_exceptions=True)
+            counted_groups = []
+            for group, is_valid in zip(groups, validity):
+                if isinstance(is_valid, BaseException):
+                    print(f"{group.name}: Validation failed due to {is_valid}", file=sys.stderr)
+                else:
+                    counted_groups.append(group)
+
+        # Kept as columns, one value per group, instead of an object per row
+        group_names = []
+        group_num_companies = []
+        results = await asyncio.gather(*[_get_total_companies(group) for group in counted_groups], return_exceptions=True)
+        for group, num_companies in zip(counted_groups, results):
+            if isinstance(num_companies, BaseException):
+                print(f"{group.name}: Counting companies failed due to {num_companies}", file=sys.stderr)
+            else:
+                group_names.append(group.name)
+                group_num_companies.append(num_companies)
+
+        with open_csv(output_path, "w") as f:
+            out_csv = csv.writer(f)
+            out_csv.writerow(["group", "num_companies"])
+            out_csv.writerows(zip(group_names, group_num_companies))
 
         if fill_cache:
-            fill_group_cache(groups, group_cache_path)
+            await fill_group_cache(groups, group_cache_path)
 
 
 def _get_group_size(args: argparse.Namespace):
-    get_group_size(args.group_cache, args.output, args.limit, args.fill, args.validate)
+    asyncio.run(get_group_size(args.group_cache, args.output, args.limit, args.concurrency, args.http_cache, args.fill, args.validate))
 
 
-def validate_group_cache(group_cache_path: Path, requests_per_second: int, fill_cache: bool):
-    with httpx.Client() as client:
-        session = HTTPSession(client, 1 / requests_per_second)
-        groups = get_groups(session, group_cache_path, not fill_cache)
-        for idx, group in enumerate(groups):
-            was_cached = group.num_pages is not None
-            is_valid = group.validate_num_pages()
+async def validate_group_cache(group_cache_path: Path, requests_per_second: int, concurrency: int, http_cache: Optional[Path], fill_cache: bool):
+    async with create_client(concurrency, http_cache) as client:
+        session = HTTPSession(client, requests_per_second, concurrency)
+        groups = await get_groups(session, group_cache_path, not fill_cache)
+        cached = [group.num_pages is not None for group in groups]
+        validity = await asyncio.gather(*[group.validate_num_pages() for group in groups], return_exceptions=True)
+        for idx, (group, was_cached, is_valid) in enumerate(zip(groups, cached, validity)):
             progress = f"[{idx + 1}/{len(groups)}]"
-            if is_valid:
+            if isinstance(is_valid, BaseException):
+                print(f"{progress} Failed: {group.name} due to {is_valid}")
+            elif is_valid:
                 print(f"{progress} Valid: {group.name}")
             elif was_cached:
                 print(f"{progress} Invalid: {group.name}")
@@ -238,17 +458,19 @@ def validate_group_cache(group_cache_path: Path, requests_per_second: int, fill_
                 print(f"{progress} Not cached: {group.name}")
 
         if fill_cache:
-            fill_group_cache(groups, group_cache_path)
+            await fill_group_cache(groups, group_cache_path)
 
 
 def _validate_group_cache(args: argparse.Namespace):
-    validate_group_cache(args.group_cache, args.limit, args.fill)
+    asyncio.run(validate_group_cache(args.group_cache, args.limit, args.concurrency, args.http_cache, args.fill))
 
 
 def main():
     parser = argparse.ArgumentParser(description="Info for groups from https://www.edb.cz/katalog-firem/")
     parser.add_argument("-l", "--limit", type=int, default=10, help="Max number of HTTP requests per second")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="Max number of HTTP requests in flight at the same time")
     parser.add_argument("-g", "--group_cache", type=Path, default="groups.json", help="Cache file with number of pages in each group to try load and store when ending")
+    parser.add_argument("--http_cache", type=Path, help="Directory to cache HTTP responses in between runs, disabled if not given, needs the http-cache extra")
 
     subparsers = parser.add_subparsers()
     num_groups_parser = subparsers.add_parser("num")
@@ -267,7 +489,7 @@ def main():
     group_size_parser = subparsers.add_parser("size")
     group_size_parser.add_argument("-f", "--fill", action="store_true", help="If uncached groups should be filled, otherwise they will be filtered out")
     group_size_parser.add_argument("-v", "--validate", action="store_true", help="Cached group sizes will be validated before use")
-    group_size_parser.add_argument("-o", "--output", type=Path, default="group_size.csv", help="Output file path")
+    group_size_parser.add_argument("-o", "--output", type=Path, default="group_size.csv", help="Output file path, gzip compressed if it ends with .gz")
     group_size_parser.set_defaults(action=_get_group_size)
 
     args = parser.parse_args()
@@ -0,0 +1,47 @@
+import io
+import asyncio
+import threading
+from typing import Callable, Iterator, Optional, Sequence, Tuple, TypeVar
+
+from lxml import etree
+
+T = TypeVar("T")
+
+_thread_local = threading.local()
+
+# Comments, processing instructions and whitespace only text are never read, so do not even create nodes for them
+_PARSER_OPTIONS = dict(remove_comments=True, remove_pis=True, remove_blank_text=True, no_network=True)
+
+
+def _get_parser(encoding: Optional[str]) -> etree.HTMLParser:
+    # lxml only releases the GIL while parsing if the parser is not shared between threads,
+    #   so each thread creates its parsers once and reuses them for every page
+    parsers = getattr(_thread_local, "parsers", None)
+    if parsers is None:
+        parsers = {}
+        _thread_local.parsers = parsers
+
+    parser = parsers.get(encoding, None)
+    if parser is None:
+        parser = etree.HTMLParser(encoding=encoding, **_PARSER_OPTIONS)
+        parsers[encoding] = parser
+    return parser
+
+
+# The encoding should be the charset from the Content-Type header if there is one,
+#   so that libxml2 does not have to detect it from the page, otherwise None to detect it
+def parse_html_tree(content: bytes, encoding: Optional[str]) -> etree._Element:
+    # Plain lxml tree, skips the lxml.html element class lookup for every element as only XPath is used
+    return etree.fromstring(content, parser=_get_parser(encoding))
+
+
+def iterparse_html(content: bytes, encoding: Optional[str], events: Sequence[str], tags: Sequence[str]) -> Iterator[Tuple[str, etree._Element]]:
+    # Streams the page instead of building the whole tree upfront, so the caller can clear the subtrees
+    #   it is done with and stop as soon as it has what it needs
+    return etree.iterparse(io.BytesIO(content), events=events, tag=tags, html=True, encoding=encoding, **_PARSER_OPTIONS)
+
+
+async def run_in_thread(func: Callable[..., T], *args) -> T:
+    # Parsing is the only CPU heavy part, so run it in the default thread pool
+    #   and let the event loop keep downloading other pages in the meantime
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
@@ -1,14 +1,107 @@
-import httpx
+import sys
 import time
+import random
+import asyncio
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+
+def create_client(concurrency: int, http_cache: Optional[Path] = None) -> httpx.AsyncClient:
+    # All requests go to the same origin, so with HTTP/2 they are multiplexed over a single kept alive connection.
+    #   Keep-alive outlasts the backoff pauses, except the longest ones, so retries reuse the connection
+    client_args = dict(
+        http2=True,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency, keepalive_expiry=120),
+        timeout=httpx.Timeout(30, connect=10)
+    )
+    if http_cache is None:
+        return httpx.AsyncClient(**client_args)
+
+    # Only needed for the optional cache, so that the scripts also run without it installed
+    try:
+        import hishel
+    except ImportError:
+        raise ImportError("HTTP cache requires hishel, install it with the http-cache extra") from None
+
+    # Responses are stored on disk between runs and revalidated with the server according to their cache headers
+    return hishel.AsyncCacheClient(
+        storage=hishel.AsyncFileStorage(base_path=http_cache),
+        controller=hishel.Controller(cacheable_methods=["GET"]),
+        **client_args
+    )
+
+
+def _get_retry_after(resp: httpx.Response) -> Optional[float]:
+    # Only the delay in seconds form is handled, the HTTP date form falls back to the exponential backoff
+    try:
+        return float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
 
 class HTTPSession:
-    def __init__(self, client: httpx.Client, delay: float):
+    def __init__(self, client: httpx.AsyncClient, requests_per_second: float, concurrency: int = 10, max_retries: int = 6, retry_delay: float = 5):
         self.c = client
-        self.delay = delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Bounds the number of requests in flight, independently of the request rate
+        self._in_flight = asyncio.Semaphore(concurrency)
+        # Token bucket holding one second worth of requests, tracked as the time at which the bucket
+        #   would be empty again, so that idle time can be used for a burst of up to requests_per_second requests
+        self._interval = 1 / requests_per_second
+        self._burst = max(0.0, 1 - self._interval)
+        self._bucket_empty_at = time.monotonic()
+        # Requests currently being made, so that identical concurrent GETs share a single request
+        self._pending: Dict[Tuple[str, tuple], "asyncio.Future[httpx.Response]"] = {}
+
+    async def delayed_get(self, url: str, params=None) -> httpx.Response:
+        key = (url, tuple(sorted(params.items())) if params else ())
+        pending = self._pending.get(key, None)
+        if pending is None:
+            pending = asyncio.ensure_future(self._delayed_get(url, params))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shielded so that one cancelled caller does not cancel the request for the others
+        return await asyncio.shield(pending)
+
+    async def _delayed_get(self, url: str, params=None) -> httpx.Response:
+        for retry in range(self.max_retries + 1):
+            await self._wait_for_token()
+            try:
+                resp = await self.get(url, params)
+            # We sometimes get a timeout when the site is overloaded, so back off exponentially and retry
+            except httpx.TimeoutException as e:
+                if retry == self.max_retries:
+                    raise
+                backoff = self._get_backoff(retry)
+                print(f"Error: Request timeout {e} for {url}, retrying in {backoff:.1f}s", file=sys.stderr)
+            else:
+                if resp.status_code != httpx.codes.TOO_MANY_REQUESTS or retry == self.max_retries:
+                    return resp
+                backoff = _get_retry_after(resp)
+                if backoff is None:
+                    backoff = self._get_backoff(retry)
+                print(f"Error: Too many requests for {url}, retrying in {backoff:.1f}s", file=sys.stderr)
+
+            # All the other requests would run into the same problem, so pause them as well
+            self._bucket_empty_at = max(self._bucket_empty_at, time.monotonic() + self._burst + backoff)
+
+    def _get_backoff(self, retry: int) -> float:
+        # Jitter so that the paused requests do not all retry at the same moment
+        return self.retry_delay * 2 ** retry + random.random()
 
-    def delayed_get(self, url: str, params=None) -> httpx.Response:
-        time.sleep(self.delay)
-        return self.get(url, params)
+    async def _wait_for_token(self):
+        # Take the token before sleeping, so concurrent requests queue up one interval apart,
+        #   and only sleep when the bucket is empty
+        now = time.monotonic()
+        bucket_empty_at = max(self._bucket_empty_at, now)
+        self._bucket_empty_at = bucket_empty_at + self._interval
+        wait = bucket_empty_at - self._burst - now
+        if wait > 0:
+            await asyncio.sleep(wait)
 
-    def get(self, url: str, params=None) -> httpx.Response:
-        return self.c.get(url, params=params)
+    async def get(self, url: str, params=None) -> httpx.Response:
+        async with self._in_flight:
+            return await self.c.get(url, params=params)
@@ -1,20 +1,17 @@
 import random
-import re
 import sys
 import csv
-import time
-import json
+import asyncio
 from pathlib import Path
-from typing import List, Optional, Dict, Set
-
-import bs4
-import httpx
+from collections import defaultdict, deque
+from typing import Deque, List, Optional, Dict, Set, Tuple
 
 import argparse
 
-from http_session import HTTPSession
-from group import Group
-from company import Company
+from http_session import HTTPSession, create_client
+from group import Group, scrape_groups, store_group_cache
+from company import Company, CSV_FIELDS
+from csv_file import open_csv
 
 
 class Sampler:
@@ -23,72 +20,107 @@ class Sampler:
             session: HTTPSession,
             groups: List[Group],
             exclude_set: Set[str],
+            batch_size: int = 1,
             num_retries: int = 10
     ):
         self.session = session
         self.groups = groups
         self.exclude_set = exclude_set
+        self.batch_size = batch_size
         self.num_retries = num_retries
+        # Companies scraped together with a previous sample from the same listing page, per group
+        #   so that they are only used when their group is drawn again
+        self.prefetched: Dict[Group, Deque[Company]] = defaultdict(deque)
 
     @classmethod
-    def scrape_groups(cls, session: HTTPSession, group_cache: Path, validate_cache: bool, exclude_set: Set[str]) -> "Sampler":
-        resp = session.delayed_get("https://www.edb.cz/katalog-firem/")
-        if resp.status_code != httpx.codes.OK:
-            raise Exception(f"Failed to get catalog: {resp.status_code}, {resp.text}")
-
-        catalog_page = bs4.BeautifulSoup(resp.text, "lxml")
-        columns = catalog_page.find_all(name="div", class_="col")
-        groups = [child for column in columns for child in column.find_all(name="h3")]
-        try:
-            with group_cache.open("r") as f:
-                group_map = json.load(f)
-        except IOError:
-            group_map = {}
-        groups = [Group(group.string, group.a["href"], session, group_map) for group in groups]
+    async def scrape_groups(cls, session: HTTPSession, group_cache: Path, validate_cache: bool, exclude_set: Set[str], batch_size: int) -> "Sampler":
+        groups = await scrape_groups(session, group_cache)
         if validate_cache:
-            for group in groups:
-                group.validate_num_pages()
+            # A group that runs out of retries is reported and keeps its cached value, so that it does not abort the sampling
+            validity = await asyncio.gather(*[group.validate_num_pages() for group in groups], return_exceptions=True)
+            for group, is_valid in zip(groups, validity):
+                if isinstance(is_valid, BaseException):
+                    print(f"{group.name}: Validation failed due to {is_valid}", file=sys.stderr)
+
+        # Finding the number of pages takes many requests, so store it as soon as it is known and not just at the end
+        for group in groups:
+            group.on_num_pages_found = lambda _: store_group_cache(groups, group_cache)
 
         return Sampler(
             session,
             groups,
-            exclude_set
+            exclude_set,
+            batch_size
         )
 
-    def get_sample(self) -> Optional[Company]:
+    async def _next_company(self, group: Group) -> Optional[Company]:
+        prefetched = self.prefetched[group]
+        if len(prefetched) != 0:
+            return prefetched.popleft()
+
+        company_urls = await group.get_random_company_urls(self.exclude_set, self.batch_size)
+        # Exclude the companies before their contact pages are even requested, so that concurrent samples
+        #   do not scrape them again and companies without emails are not scraped repeatedly
+        self.exclude_set.update(company_urls)
+        # All the companies are known from the single listing page, so scrape them at the same time
+        companies = await group.scrape_companies(company_urls)
+        # We may have hit a page with all companies excluded
+        if len(companies) == 0:
+            return None
+        prefetched.extend(companies[1:])
+        return companies[0]
+
+    async def get_sample(self) -> Optional[Company]:
         group = random.choice(self.groups)
         for retry in range(self.num_retries):
             try:
-                company = group.get_random_company(self.exclude_set)
-                # We may have hit a page with all companies excluded
+                company = await self._next_company(group)
                 if company is None:
                     continue
 
                 if len(company.emails) != 0:
-                    self.exclude_set.add(company.contacts_url)
                     return company
                 else:
                     print(f"Sample failed as company {company.name}: '{company.contacts_url}'  has no emails", file=sys.stderr)
                     if retry + 1 == self.num_retries:
                         print(f"Sample failed as group {group.name} has too many companies without emails")
                         return None
-            # We sometimes get a timeout, so wait a minute and retry
-            except httpx.TimeoutException as e:
-                print(f"Sample failed due to timeout {e}, waiting a minute and retrying", file=sys.stderr)
-                time.sleep(60)
             except Exception as e:
                 print(f"Sample failed due to {e}", file=sys.stderr)
         # raise Exception(f"Failed in all {self.num_retries} retries")
         return None
 
     def store_group_cache(self, path: Path):
-        group_cache = {}
-        for group in self.groups:
-            if group.num_pages is not None:
-                group_cache[group.name] = group.num_pages
+        store_group_cache(self.groups, path)
+
+
+WRITE_BATCH_SIZE = 32
+
+
+async def collect_samples(sampler: Sampler, requested_samples: int, concurrency: int, email_out_csv: "csv._writer"):
+    collected_samples = 0
+    pending_rows: List[Tuple[str, str, str, str]] = []
+
+    async def sample_worker():
+        nonlocal collected_samples
+        while collected_samples < requested_samples:
+            company = await sampler.get_sample()
+            # The other workers may have collected the rest of the samples while this one was waiting
+            if company is None or collected_samples >= requested_samples:
+                continue
+            pending_rows.extend(company.to_csv_rows())
+            collected_samples += 1
+            print(f"[{collected_samples}]: {company.name} with {len(company.emails)} email{'' if len(company.emails) == 1 else 's'}")
+            if collected_samples % WRITE_BATCH_SIZE == 0:
+                email_out_csv.writerows(pending_rows)
+                pending_rows.clear()
 
-        with path.open("w", encoding="utf8") as f:
-            json.dump(group_cache, f, ensure_ascii=False)
+    try:
+        # Each worker has at most one sample in flight, the session limits the actual request rate
+        await asyncio.gather(*[sample_worker() for _ in range(concurrency)])
+    finally:
+        # Do not lose the samples collected since the last batch if the sampling fails or is interrupted
+        email_out_csv.writerows(pending_rows)
 
 
 def load_exclude_set(exclude: Optional[List[Path]]) -> Set[str]:
@@ -96,40 +128,42 @@ def load_exclude_set(exclude: Optional[List[Path]]) -> Set[str]:
         return set()
     exclude_set = set()
     for file in exclude:
-        with file.open("r") as f:
-            reader = csv.DictReader(f)
-            exclude_set.update((row["url"] for row in reader))
+        with open_csv(file, "r") as f:
+            # Only the url column is needed, so index it directly instead of building a dict for every row
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                continue
+            url_idx = header.index("url")
+            # Blank lines and a row cut short by a killed run do not have the url
+            exclude_set.update(row[url_idx] for row in reader if len(row) > url_idx)
     return exclude_set
 
 
-def run_sampling(
+async def run_sampling(
         requested_samples: int,
         append: bool,
         output_path: Path,
         requests_per_second: int,
+        concurrency: int,
+        http_cache: Optional[Path],
         group_cache: Path,
         validate_cache: bool,
-        exclude: Optional[List[Path]]
+        exclude: Optional[List[Path]],
+        batch_size: int
 ):
     output_exists = output_path.exists()
     exclude_set = load_exclude_set(exclude)
-    with output_path.open("a" if append else "w", newline="") as email_out:
-        email_out_csv = csv.DictWriter(email_out, fieldnames=["name", "email", "group", "url"])
+    with open_csv(output_path, "a" if append else "w") as email_out:
+        email_out_csv = csv.writer(email_out)
         if not output_exists or not append:
-            email_out_csv.writeheader()
+            email_out_csv.writerow(CSV_FIELDS)
 
-        with httpx.Client() as client:
-            sampler = Sampler.scrape_groups(HTTPSession(client, 1 / requests_per_second), group_cache, validate_cache, exclude_set)
+        async with create_client(concurrency, http_cache) as client:
+            session = HTTPSession(client, requests_per_second, concurrency)
+            sampler = await Sampler.scrape_groups(session, group_cache, validate_cache, exclude_set, batch_size)
             try:
-                collected_samples = 0
-                while collected_samples < requested_samples:
-                    print(f"[{collected_samples}]: ", end="")
-                    company = sampler.get_sample()
-                    if company is None:
-                        continue
-                    company.to_csv(email_out_csv)
-                    collected_samples += 1
-                    print(f"{company.name} with {len(company.emails)} email{'' if len(company.emails) == 1 else 's'}")
+                await collect_samples(sampler, requested_samples, concurrency, email_out_csv)
             finally:
                 sampler.store_group_cache(group_cache)
 
@@ -137,15 +171,18 @@ def run_sampling(
 def main():
     parser = argparse.ArgumentParser(description="Sampling of https://www.edb.cz/katalog-firem/")
     parser.add_argument("-a", "--append", action="store_true", help="If output should be appended to existing file")
-    parser.add_argument("-o", "--output", type=Path, default="contacts.csv", help="Output file path")
+    parser.add_argument("-o", "--output", type=Path, default="contacts.csv", help="Output file path, gzip compressed if it ends with .gz")
     parser.add_argument("-l", "--limit", type=int, default=10, help="Max number of HTTP requests per second")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="Max number of HTTP requests in flight at the same time")
     parser.add_argument("-g", "--group_cache", type=Path, default="groups.json", help="Cache file with number of pages in each group to try load and store when ending")
+    parser.add_argument("--http_cache", type=Path, help="Directory to cache HTTP responses in between runs, disabled if not given, needs the http-cache extra")
     parser.add_argument("-v", "--validate_cache", action="store_true", help="Validate the number of pages stored in cache")
     parser.add_argument("-e", "--exclude", nargs="*", type=Path, help="CSV file containing companies to exclude")
+    parser.add_argument("-b", "--batch_size", type=int, default=1, help="Number of companies to sample from each fetched listing page, larger batches need fewer requests but the sample is less random")
     parser.add_argument("num_samples", type=int, help="Number of samples to gather")
 
     args = parser.parse_args()
-    run_sampling(args.num_samples, args.append, args.output, args.limit, args.group_cache, args.validate_cache, args.exclude)
+    asyncio.run(run_sampling(args.num_samples, args.append, args.output, args.limit, args.concurrency, args.http_cache, args.group_cache, args.validate_cache, args.exclude, args.batch_size))
 
 
 if __name__ == "__main__":